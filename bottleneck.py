@@ -23,10 +23,7 @@ FLAGS = {
         'BATCH_SIZE':                   100,
 }
 
-def _raw_inputs(name, num_epochs, predict):
-    file_queue = tf.train.string_input_producer([os.path.join(FLAGS['BOTTLENECK_DIR'], name+'.tfrecords')], num_epochs=num_epochs)
-    reader = tf.TFRecordReader()
-    _, serialized_example = reader.read(file_queue)
+def _parse_example(serialized_example, predict):
     features = tf.parse_single_example(serialized_example, features={
         'bottleneck': tf.FixedLenFeature([FLAGS['BOTTLENECK_SIZE']], tf.float32),
         'label': tf.FixedLenFeature([1], tf.int64),
@@ -40,6 +37,12 @@ def _raw_inputs(name, num_epochs, predict):
 
     return bottleneck, label
 
+def _raw_inputs(name, num_epochs, predict):
+    records = tf.data.TFRecordDataset([os.path.join(FLAGS['BOTTLENECK_DIR'], name+'.tfrecords')])
+    return records.repeat(num_epochs).map(
+            lambda serialized_example: _parse_example(serialized_example, predict=predict),
+            num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
 """Return a batch of bottleneck, label pairs.
 
 Arguments:
@@ -51,9 +54,9 @@ Arguments:
                 if predict=False, the label is the numerical image ID of each unlabelled image
 """
 def inputs(name='train', batch_size=FLAGS['BATCH_SIZE'], num_epochs=1, predict=False):
-    bottleneck, label = _raw_inputs(name, num_epochs, predict=predict)
+    examples = _raw_inputs(name, num_epochs, predict=predict)
 
-    bottlenecks, labels = tf.train.shuffle_batch([bottleneck, label], batch_size=batch_size, capacity=1000+3*batch_size, min_after_dequeue=1000, num_threads=8)
+    bottlenecks, labels = dataset.next_batch(examples, batch_size=batch_size)
 
     return bottlenecks, labels
 
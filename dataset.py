@@ -30,6 +30,9 @@ def image_len():
 
 """The dimensions of unflattened images.
 
+With `include_channels=True` this is the per-example NHWC shape expected by
+`tfutil.conv_op`, so flat batches can be reshaped with `[-1] + list(image_dim(True))`.
+
 Arguments:
     include_channels    whether to include the channel dimension
 """
@@ -38,10 +41,7 @@ def image_dim(include_channels=False):
         return (FLAGS['IMAGE_SIZE'], FLAGS['IMAGE_SIZE'], FLAGS['IMAGE_CHANNELS'])
     return (FLAGS['IMAGE_SIZE'], FLAGS['IMAGE_SIZE'])
 
-def _raw_inputs(name, num_epochs, predict):
-    file_queue = tf.train.string_input_producer([os.path.join(FLAGS['DATA_DIR'], name+'.tfrecords')], num_epochs=num_epochs)
-    reader = tf.TFRecordReader()
-    _, serialized_example = reader.read(file_queue)
+def _parse_example(serialized_example, predict):
     features = tf.parse_single_example(serialized_example, features={
         'image_raw': tf.FixedLenFeature([], tf.string),
         'label': tf.FixedLenFeature([], tf.int64),
@@ -56,6 +56,24 @@ def _raw_inputs(name, num_epochs, predict):
 
     return image, label
 
+def _raw_inputs(name, num_epochs, predict):
+    records = tf.data.TFRecordDataset([os.path.join(FLAGS['DATA_DIR'], name+'.tfrecords')])
+    return records.repeat(num_epochs).map(
+            lambda serialized_example: _parse_example(serialized_example, predict=predict),
+            num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+"""Shuffle and batch a `tf.data.Dataset` of examples.
+
+Returns the tensors of the next batch from a one-shot iterator, which raise
+`tf.errors.OutOfRangeError` once the dataset is exhausted. Incomplete final
+batches are dropped, so the batch dimension is always `batch_size`.
+"""
+def next_batch(examples, batch_size):
+    examples = examples.shuffle(buffer_size=1000+3*batch_size)
+    examples = examples.batch(batch_size, drop_remainder=True)
+    examples = examples.prefetch(tf.data.experimental.AUTOTUNE)
+    return examples.make_one_shot_iterator().get_next()
+
 """Return a batch of image, label pairs.
 
 Arguments:
@@ -69,13 +87,15 @@ Arguments:
                 if predict=False, the label is the numerical image ID of each unlabelled image
 """
 def inputs(name='train', batch_size=FLAGS['BATCH_SIZE'], num_epochs=1, display=False, predict=False):
-    image, label = _raw_inputs(name, num_epochs, predict=predict)
+    examples = _raw_inputs(name, num_epochs, predict=predict)
 
     # setting display=True disables centering and normalisation so images can be correctly displayed
     if not display:
-        image = tf.cast(image, tf.float32) * (1./255) - 0.5
+        examples = examples.map(
+                lambda image, label: (tf.cast(image, tf.float32) * (1./255) - 0.5, label),
+                num_parallel_calls=tf.data.experimental.AUTOTUNE)
 
-    images, labels = tf.train.shuffle_batch([image, label], batch_size=batch_size, capacity=1000+3*batch_size, min_after_dequeue=1000, num_threads=8)
+    images, labels = next_batch(examples, batch_size=batch_size)
     labels = tf.reshape(labels, [batch_size, 1])
     return images, labels
 
@@ -9,6 +9,8 @@ import os.path
 from sklearn.model_selection import train_test_split
 import tensorflow as tf
 
+import dataset
+
 FLAGS = {
         'IMAGE_SIZE':       299,
         'IMAGE_CHANNELS':   3,
@@ -72,18 +74,12 @@ Arguments:
 """
 def inputs(name='train', batch_size=FLAGS['BATCH_SIZE'], num_epochs=1, display=False, predict=False):
     file_list = data_files[name]
-    filename_queue = tf.train.string_input_producer(file_list, num_epochs=num_epochs)
-    reader = tf.WholeFileReader()
-
-    image, label = read_image(filename_queue=filename_queue, predict=predict, reader=reader)
+    examples = tf.data.Dataset.from_tensor_slices(file_list).shuffle(buffer_size=len(file_list))
+    examples = examples.repeat(num_epochs).map(
+            lambda filename: decode_image(key=filename, content=tf.read_file(filename), predict=predict),
+            num_parallel_calls=tf.data.experimental.AUTOTUNE)
 
-    images, labels = tf.train.shuffle_batch(
-        [image, label],
-        batch_size=batch_size,
-        capacity=1000+3*batch_size,
-        min_after_dequeue=1000,
-        num_threads=8
-    )
+    images, labels = dataset.next_batch(examples, batch_size=batch_size)
     labels = tf.reshape(labels, [batch_size, 1])
 
     return images, labels
@@ -116,7 +112,14 @@ Returns:
 """
 def read_image(filename_queue, predict, reader):
     key, content = reader.read(filename_queue)
+    return decode_image(key=key, content=content, predict=predict)
 
+"""Decode JPEG data `content` read from file `key` and distort it if required.
+
+Returns:
+    The (distorted) image and its label
+"""
+def decode_image(key, content, predict):
     image = tf.image.decode_jpeg(content, channels=3)
     image = distort(image)
 
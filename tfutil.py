@@ -1,13 +1,28 @@
 """Some useful helper functions for working with NNs in TensorFlow."""
-import glob
 import math
 import os
+import shutil
+import weakref
 
 import numpy as np
 import tensorflow as tf
+from tensorflow.contrib.compiler import jit
+from tensorflow.core.protobuf import rewriter_config_pb2
 
 from dataset import FLAGS
 
+# tensor layout for convolution and pooling ops: `[batch, height, width, channels]`
+# (preferred by cuDNN/Tensor Cores; avoids implicit NCHW transposes around each layer)
+DATA_FORMAT = 'NHWC'
+
+# if True, convolutions are computed in float16 (eligible for Tensor Cores) while
+# the weights themselves are kept in float32; Tensor Cores additionally require the
+# number of input and output channels to be multiples of 8
+# off by default: Grappler's remapper only fuses float32 conv + bias_add + relu (see
+# `conv_op`), and on CPU half precision convolution is emulated and much slower,
+# so only enable this when training on a Tensor Core GPU
+MIXED_PRECISION = False
+
 ####### VARIABLE CREATION
 """Create a weight variable initalized with a random normal distribution.
 
@@ -77,31 +92,68 @@ def bias_variable(shape, value=0.1):
 
 
 ######## NETWORK BUILDING
-"""Create a convolutional layer with stride `[1,stride,stride,1]`."""
+"""Create a convolutional layer with stride `[1,stride,stride,1]`.
+
+The input `X` must be laid out as `DATA_FORMAT`, i.e. `[batch, height, width, channels]`.
+
+If `MIXED_PRECISION` is set, the convolution, bias and nonlinearity are computed in
+float16 from float32 master weights, and the result is cast back to float32. These
+float16 ops are not fused into a single kernel.
+
+With `MIXED_PRECISION`, a 3 channel (RGB) input is zero-padded along the channel
+dimension to 8 channels so that the first layer is also eligible for Tensor Cores.
+
+For 3x3 kernels with stride 1 and channel counts that are multiples of 8, cuDNN's
+autotuner (on by default in TensorFlow) can select its Winograd algorithms, which need
+considerably fewer multiplications than direct or GEMM-based convolution.
+"""
 def conv_op(X, size, channels, name, stride, padding='SAME', relu=True):
     with tf.variable_scope(name):
         weights = conv_weight_variable(size=size, channels=channels)
+        if MIXED_PRECISION and channels[0] == 3:
+            # pad input and weights with zero channels, which do not change the output;
+            # the weight variable itself (and its initialization) keeps 3 input channels
+            num_pad = 8 - channels[0]
+            input_padding = [[0, 0]] * 4
+            input_padding[DATA_FORMAT.index('C')] = [0, num_pad]
+            X = tf.pad(X, input_padding)
+            weights = tf.pad(weights, [[0, 0], [0, 0], [0, num_pad], [0, 0]])
         bias = bias_variable(shape=channels[-1])
-        h_conv = tf.nn.conv2d(X, weights, strides=[1, stride, stride, 1], padding=padding) + bias
+        if MIXED_PRECISION:
+            X = tf.cast(X, tf.float16)
+            weights = tf.cast(weights, tf.float16)
+            bias = tf.cast(bias, tf.float16)
+        # bias_add (rather than `+`) lets Grappler's remapper fuse conv, bias and relu
+        # into a single `_FusedConv2D` kernel, see `session_config`; the remapper only
+        # does this for float32, so the fusion does not apply with `MIXED_PRECISION`
+        h_conv = tf.nn.bias_add(
+                tf.nn.conv2d(X, weights, strides=[1, stride, stride, 1], padding=padding, data_format=DATA_FORMAT),
+                bias,
+                data_format=DATA_FORMAT)
         if relu:
             h_out = tf.nn.relu(h_conv)
         else:
             h_out = h_conv
+        if MIXED_PRECISION:
+            h_out = tf.cast(h_out, tf.float32)
     return h_out
 
 """Exception raised if pooling mode below is set to a value other than `avg` or `max`."""
 class BadPoolMode(Exception):
     pass
 
-"""Create a pooling layer with size `[1,size,size,1]` and stride `[1,stride,stride,1]`."""
+"""Create a pooling layer with size `[1,size,size,1]` and stride `[1,stride,stride,1]`.
+
+The input `X` must be laid out as `DATA_FORMAT`, i.e. `[batch, height, width, channels]`.
+"""
 def pool_op(X, size, stride, name, padding='SAME', mode='max'):
     ksize = [1, size, size, 1]
     strides = [1, stride, stride, 1]
     with tf.variable_scope(name):
         if mode == 'avg':
-            h_pool = tf.nn.avg_pool(X, ksize=ksize, strides=strides, padding=padding, name=name)
+            h_pool = tf.nn.avg_pool(X, ksize=ksize, strides=strides, padding=padding, data_format=DATA_FORMAT, name=name)
         elif mode == 'max':
-            h_pool = tf.nn.max_pool(X, ksize=ksize, strides=strides, padding=padding, name=name)
+            h_pool = tf.nn.max_pool(X, ksize=ksize, strides=strides, padding=padding, data_format=DATA_FORMAT, name=name)
         else:
             raise BadPoolMode()
     return h_pool
@@ -147,8 +199,17 @@ def fc_op(X, channels_in, channels_out, name, reg_terms=None, alpha=0.0, relu=Tr
 Also adds any regularization terms to the loss operation before returning it."""
 def loss_op(logits, labels, name='', reg_terms=None):
     name = name + ('_' if name else '') + 'xentropy'
-    cross_entropy = tf.nn.sigmoid_cross_entropy_with_logits(logits=logits, labels=labels, name=name)
-    cross_entropy_avg = tf.reduce_mean(cross_entropy, name=name+'_avg')
+    # the formula below broadcasts, so check shapes as `sigmoid_cross_entropy_with_logits` does
+    labels.get_shape().assert_is_compatible_with(logits.get_shape())
+    with jit.experimental_jit_scope():
+        # numerically stable form of sigmoid cross entropy, as computed by
+        # `tf.nn.sigmoid_cross_entropy_with_logits`, written out so that XLA can fuse it:
+        #   max(x, 0) - x * z + log(1 + exp(-|x|))
+        cross_entropy = tf.add(
+                tf.nn.relu(logits) - logits * labels,
+                tf.nn.softplus(-tf.abs(logits)),
+                name=name)
+        cross_entropy_avg = tf.reduce_mean(cross_entropy, name=name+'_avg')
     tf.summary.scalar(name+'_avg', cross_entropy_avg)
 
     loss = cross_entropy_avg
@@ -162,13 +223,19 @@ def loss_op(logits, labels, name='', reg_terms=None):
 """Add nodes to the graph to compute accuracy and write it to summary files."""
 def accuracy_op(logits, labels, name=''):
     name = name + ('_' if name else '') + 'accuracy'
-    activation = tf.nn.sigmoid(logits)
-    correct_prediction = tf.equal(tf.greater(activation, 0.5), tf.greater(labels, 0.5))
-    accuracy = tf.reduce_mean(tf.cast(correct_prediction, tf.float32), name=name)
+    with jit.experimental_jit_scope():
+        # sigmoid is monotonic with sigmoid(0) = 0.5, so thresholding the logits at 0
+        # gives the same predictions without computing the activation
+        correct_prediction = tf.equal(tf.greater(logits, 0.0), tf.greater(labels, 0.5))
+        accuracy = tf.reduce_mean(tf.cast(correct_prediction, tf.float32), name=name)
     tf.summary.scalar(name=name, tensor=accuracy)
     return accuracy
 
-"""Add nodes to the graph to do training and track the overall training step."""
+"""Add nodes to the graph to do training and track the overall training step.
+
+If `MIXED_PRECISION` is set, the optimizer is wrapped with dynamic loss scaling
+so that small float16 gradients do not underflow.
+"""
 def train_op(loss, learning_rate, optimizer=tf.train.AdamOptimizer):
     global_step = tf.get_variable(
             name='global_step',
@@ -176,23 +243,47 @@ def train_op(loss, learning_rate, optimizer=tf.train.AdamOptimizer):
             initializer=tf.constant_initializer(value=0),
             trainable=False,
             dtype=tf.int32,
+            # registered as the global step so that session hooks can track it
+            collections=[tf.GraphKeys.GLOBAL_VARIABLES, tf.GraphKeys.GLOBAL_STEP],
             )
-    return optimizer(learning_rate).minimize(loss, global_step=global_step)
+    opt = optimizer(learning_rate)
+    if MIXED_PRECISION:
+        loss_scale_manager = tf.contrib.mixed_precision.ExponentialUpdateLossScaleManager(
+                init_loss_scale=2**15,
+                incr_every_n_steps=2000)
+        opt = tf.contrib.mixed_precision.LossScaleOptimizer(opt, loss_scale_manager)
+    return opt.minimize(loss, global_step=global_step)
+
+# callables built by `avg_op`, keyed by session and then by op; `make_callable`
+# always builds new executors, so each callable is created once and then reused
+_avg_op_callables = weakref.WeakKeyDictionary()
 
 """Evaluate operation `op` over a number of batches.
 
 Arguments:
-    sess            the TensorFlow session
+    sess            the TensorFlow session (a `tf.train.MonitoredSession` is also accepted,
+                    in which case its hooks are bypassed)
     op              the desired operation
     num_examples    total number of examples over which to average
 
 Number of batches is `ceil(num_examples / BATCH_SIZE)
 """
 def avg_op(sess, op, num_examples=2500):
+    if isinstance(sess, tf.train.MonitoredSession):
+        return sess.run_step_fn(lambda step_context: avg_op(step_context.session, op, num_examples=num_examples))
+
+    callables = _avg_op_callables.setdefault(sess, {})
+    if op not in callables:
+        callables[op] = sess.make_callable(op)
+    run_op = callables[op]
+
     num_batches = int(math.ceil(num_examples / FLAGS['BATCH_SIZE']))
+    # `op` draws a fresh batch from its input pipeline each time it is evaluated, so
+    # it must be run once per batch: an in-graph loop (e.g. `tf.while_loop`) would
+    # capture the already-built `op`, evaluate it once and average the same batch
     acc = np.zeros(op.get_shape())
-    for i in range(num_batches):
-        acc += sess.run(op)
+    for _ in range(num_batches):
+        acc += run_op()
     return acc / num_batches
 
 
@@ -224,10 +315,10 @@ def create_if_needed(path):
 def run_cleanup(name):
     tf.reset_default_graph()
 
-    for file in glob.glob(log_dir(name, pattern=True)):
-        os.remove(file)
-    for file in glob.glob(checkpoint_dir(name, pattern=True)):
-        os.remove(file)
+    # remove each directory in one go rather than globbing and deleting file by file
+    for path in [log_dir(name), checkpoint_dir(name)]:
+        shutil.rmtree(path, ignore_errors=True)
+        create_if_needed(path)
     for clip in [False, True]:
         filename = prediction_file(name, clip=clip)
         if os.path.isfile(filename):
@@ -238,41 +329,75 @@ def run_setup(name):
     create_if_needed(log_dir(name))
     create_if_needed(checkpoint_dir(name))
 
-"""Run some operation inside a session, starting threads as needed.
+"""Create the `tf.ConfigProto` used for all sessions.
+
+Enables Grappler's remapper so that conv + bias_add + relu chains built by
+`conv_op` are fused into a single kernel, and XLA auto-clustering so that chains
+of small elementwise ops in the forward pass and loss are compiled into few kernels
+(optimizer updates on ref variables are not clustered, see `run_training`).
+"""
+def session_config():
+    config = tf.ConfigProto(log_device_placement=True)
+    config.graph_options.rewrite_options.remapping = rewriter_config_pb2.RewriterConfig.ON
+    config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+    return config
+
+"""Run some operation inside a session until its inputs are exhausted.
+
+Checkpoints and summaries are written by session hooks rather than from `func`,
+so that saving does not block the main loop and summaries are fetched in the same
+`run` call as the training op.
 
 Arguments:
-    func            function to run in the main loop
-    after           function to run after the loop
-    name            name for the operation
-    checkpoint_path path of a trained checkpoint file to restore
-    checkpoint      checkpoint object to restore from (only used if checkpoint_path=None)
-    step            the starting global step, 0 used if None
-    func_args       keyword args to be passed to `func` and `after`
+    func                    function to run in the main loop
+    after                   function to run after the loop
+    name                    name for the operation
+    checkpoint_path         path of a trained checkpoint file to restore
+    checkpoint              checkpoint object to restore from (only used if checkpoint_path=None)
+    step                    the starting global step, 0 used if None
+    save_steps              if set, save a checkpoint every `save_steps` global steps
+    save_summaries_steps    if set, write summaries every `save_summaries_steps` global steps
+    func_args               keyword args to be passed to `func` and `after`
 """
-def run_in_tf(func, after, name, checkpoint_path=None, checkpoint=None, step=None, **func_args):
+def run_in_tf(func, after, name, checkpoint_path=None, checkpoint=None, step=None, save_steps=None, save_summaries_steps=None, **func_args):
     init_op = tf.group(tf.global_variables_initializer(), tf.local_variables_initializer())
 
     try:
-        saver = tf.train.Saver(max_to_keep=10, keep_checkpoint_every_n_hours=1)
+        # sharded saves write each device's variables in parallel
+        saver = tf.train.Saver(max_to_keep=10, keep_checkpoint_every_n_hours=1, sharded=True, save_relative_paths=True)
     except ValueError: # no variables to save
         saver = None
 
-    sess = tf.Session(config=tf.ConfigProto(log_device_placement=True))
-
     summary_op = tf.summary.merge_all()
-    log_writer = tf.summary.FileWriter(logdir=os.path.join(FLAGS['LOG_DIR'], name), graph=sess.graph)
-
-    sess.run(init_op)
+    log_writer = tf.summary.FileWriter(logdir=os.path.join(FLAGS['LOG_DIR'], name), graph=tf.get_default_graph())
 
     # checkpoint_path takes precedence over checkpoint
-    if saver is not None:
-        if checkpoint_path is not None:
-            saver.restore(sess, checkpoint_path)
-        elif checkpoint is not None:
-            saver.restore(sess, checkpoint.model_checkpoint_path)
-
-    coord = tf.train.Coordinator()
-    threads = tf.train.start_queue_runners(sess=sess, coord=coord)
+    if saver is None:
+        checkpoint_path = None
+    elif checkpoint_path is None and checkpoint is not None:
+        checkpoint_path = checkpoint.model_checkpoint_path
+
+    hooks = []
+    if save_steps is not None and saver is not None:
+        hooks.append(tf.train.CheckpointSaverHook(
+                checkpoint_dir=checkpoint_dir(name),
+                save_steps=save_steps,
+                saver=saver,
+                checkpoint_basename=name,
+                ))
+    if save_summaries_steps is not None and summary_op is not None:
+        hooks.append(tf.train.SummarySaverHook(
+                save_steps=save_summaries_steps,
+                summary_writer=log_writer,
+                summary_op=summary_op,
+                ))
+
+    session_creator = tf.train.ChiefSessionCreator(
+            scaffold=tf.train.Scaffold(init_op=init_op, saver=saver),
+            config=session_config(),
+            checkpoint_filename_with_path=checkpoint_path,
+            )
+    sess = tf.train.MonitoredSession(session_creator=session_creator, hooks=hooks)
 
     if step is None:
         step = 0
@@ -289,24 +414,26 @@ def run_in_tf(func, after, name, checkpoint_path=None, checkpoint=None, step=Non
         if after is not None:
             after(step=step, **func_args, **kwargs)
 
+    # `tf.data` inputs raise OutOfRangeError once `num_epochs` have been consumed
     if func is not None:
         try:
-            while not coord.should_stop():
+            while True:
                 func(step=step, **func_args, **kwargs)
                 step += 1
         except tf.errors.OutOfRangeError:
             after_func(step=step)
-        finally:
-            coord.request_stop()
     else:
         after_func(step=step)
-        coord.request_stop()
 
-    coord.join(threads)
+    # closing the session runs the hooks' `end`, which saves a final checkpoint
     sess.close()
 
     return step
 
+# summaries have no XLA kernels, so keep ops like those in `fc_op` out of jit scopes
+def _compile_unless_summary(node_def):
+    return 'Summary' not in node_def.op
+
 """Run training, write summaries and save checkpoints.
 
 Arguments:
@@ -328,7 +455,10 @@ def run_training(name, learning_rate, num_epochs, inference_op, inputs, reg_term
     checkpoint = tf.train.get_checkpoint_state(checkpoint_dir(name))
 
     images, labels = inputs(name='train', num_epochs=num_epochs)
-    logits = inference_op(images, reg_terms=reg_terms, train=True)
+    # compile the forward pass with XLA (the loss has its own scope in `loss_op`);
+    # the weight updates are left out since XLA does not cluster ref variable updates
+    with jit.experimental_jit_scope(compile_ops=_compile_unless_summary):
+        logits = inference_op(images, reg_terms=reg_terms, train=True)
     loss = loss_op(logits, labels, reg_terms=reg_terms)
 
     train = train_op(loss, learning_rate=learning_rate, optimizer=optimizer)
@@ -356,6 +486,8 @@ def run_training(name, learning_rate, num_epochs, inference_op, inputs, reg_term
             'name':                 name,
             'checkpoint':           checkpoint,
             'step':                 step,
+            'save_steps':           250,
+            'save_summaries_steps': 100,
             }
 
     return run_in_tf(func=_training_func,
@@ -370,26 +502,23 @@ def _print_avg_op(sess, op, label, percent=False):
         format_string = '{}: {:' + number_format_string + '}'
         print(format_string.format(label, avg_value))
 
-def _training_func(loss, train, log_writer, summary_op, train_accuracy_op, valid_accuracy_op, train_loss_op, valid_loss_op, sess, saver, step, name, **kwargs_unused):
+# checkpoints and summaries are written by the hooks set up in `run_in_tf`
+def _training_func(loss, train, train_accuracy_op, valid_accuracy_op, train_loss_op, valid_loss_op, sess, step, **kwargs_unused):
     if step % 1000 == 0:
         _run_eval(sess=sess, train_accuracy_op=train_accuracy_op, valid_accuracy_op=valid_accuracy_op, test_accuracy_op=None, train_loss_op=train_loss_op, valid_loss_op=valid_loss_op, test_loss_op=None)
 
+    # everything needed this step is fetched in a single `run` call
+    fetches = {'train': train}
     if step % 250 == 0:
-        summary, xentropy = sess.run([summary_op, loss])
-        saver.save(sess, os.path.join(FLAGS['CHECKPOINT_DIR'], name, name), global_step=step)
-        log_writer.add_summary(summary, global_step=step)
-        print('Cross Entropy: {xentropy:.3f}'.format(xentropy=xentropy))
+        fetches['loss'] = loss
 
-    if step % 100 == 0:
-        summary = sess.run(summary_op)
-        log_writer.add_summary(summary, global_step=step)
+    results = sess.run(fetches)
 
-    sess.run(train)
+    if 'loss' in results:
+        print('Cross Entropy: {xentropy:.3f}'.format(xentropy=results['loss']))
 
-def _training_after(sess, saver, step, name, **kwargs):
+def _training_after(sess, step, **kwargs):
     print('Done training for {} steps.'.format(step))
-    if saver is not None:
-        saver.save(sess, os.path.join(FLAGS['CHECKPOINT_DIR'], name, name), global_step=step)
     _run_eval(sess=sess, **kwargs)
 
 """Make predictions given a logit node in the graph, using the model at its current state of training.
@@ -431,10 +560,11 @@ def _prediction_func(outfile, activation_op, image_ids, sess, saver, step, name,
     dog_prob, image_id = sess.run([activation_op, image_ids])
     if clip:
         np.clip(dog_prob, a_min=0.05, a_max=0.95, out=dog_prob)
-    dog_prob = dog_prob.reshape([-1, 1])
 
-    np.savetxt(fname=outfile, X=np.append(image_id, dog_prob, 1), fmt=['%i', '%.2f'], delimiter=',')
-    outfile.flush()
+    # format the whole batch at once rather than row by row; `outfile` is buffered,
+    # so there is no need to flush after each batch
+    lines = np.char.add(np.char.add(np.char.mod('%i', image_id.ravel()), ','), np.char.mod('%.2f', dog_prob.ravel()))
+    outfile.write(('\n'.join(lines) + '\n').encode())
 
 def _prediction_after(step, name, clip, **kwargs):
     print('Wrote predictions to {}'.format(prediction_file(name, clip=clip)))